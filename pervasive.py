@@ -3,20 +3,23 @@
 # found in the LICENSE file.
 from datetime import date
 from dateutil.relativedelta import relativedelta
+from google.api_core import exceptions
 from google.cloud import bigquery
-from urllib.parse import urlparse
+import bisect
 import calendar
+import concurrent.futures
 import difflib
 import logging
+import orjson
 import os
-import pandas as pd
 import re
 import string
+import threading
 import zstandard as zstd
 try:
-  import ujson as json
-except BaseException:
-  import json
+  from google.cloud import bigquery_storage
+except ImportError:
+  bigquery_storage = None
 
 # Minimum number of ovvurrences per month to be considered "pervasive"
 PERVASIVE_COUNT = 100000
@@ -56,78 +59,112 @@ FILENAME_IGNORE = ['.js', '.css', 'bundle', '.min', '.', '-', '[', ']']
 # Compression level for the inline zstd-compressed pervasive list
 ZSTD_COMPRESSION_LEVEL = 19
 
+# Maximum number of monthly queries to run concurrently
+MAX_QUERY_THREADS = 8
+
+# Maximum run time for a single monthly query job (milliseconds)
+QUERY_JOB_TIMEOUT_MS = 2 * 60 * 60 * 1000
+
+# How long to keep retrying transient BigQuery API errors (seconds)
+QUERY_RETRY_TIMEOUT = 60 * 60
+
+# Number of rows to fetch per page when streaming the BigQuery results
+RESULTS_PAGE_SIZE = 10000
+
+# Write buffer size for the monthly results files
+RESULTS_WRITE_BUFFER = 1 << 20
+
 
 class Collect(object):
 
   def __init__(self):
-    self.query = """
+    self.query = r"""
         #standardSQL
+        WITH base AS (
+            SELECT
+                url,
+                JSON_VALUE(payload, "$._body_hash") as body_hash,
+                SAFE_CAST(JSON_VALUE(payload, "$._objectSize") AS INT64)
+                    as size,
+                SAFE_CAST(JSON_VALUE(payload, "$._responseCode") AS INT64)
+                    as code,
+                (SELECT h.value FROM UNNEST(request_headers) as h
+                 WHERE lower(h.name) = "sec-fetch-dest" LIMIT 1) as dest,
+                ARRAY(SELECT AS STRUCT h.name, h.value
+                      FROM UNNEST(response_headers) as h
+                      WHERE lower(h.name) IN ("cache-control", "set-cookie",
+                                              "use-as-dictionary"))
+                    as response_headers
+            FROM
+                `httparchive.crawl.requests`
+            WHERE
+                date = @date AND
+                STRPOS(url, "?") = 0 AND
+                EXISTS (SELECT 1 FROM UNNEST(response_headers) as h
+                        WHERE lower(h.name) = "cache-control" AND
+                              REGEXP_CONTAINS(lower(h.value),
+                                              r"(^|[,;])\s*public\s*([,;]|$)"))
+        )
         SELECT
             url,
             ANY_VALUE(dest) as dest,
             ANY_VALUE(size) as size,
-            ANY_VALUE(request_headers) as request_headers,
             ANY_VALUE(response_headers) as response_headers,
             body_hash,
             COUNT(*) as num
-        FROM (
-            SELECT
-                url,
-                PARSE_NUMERIC(JSON_VALUE(payload, "$._objectSize")) as size,
-                JSON_VALUE(payload, "$._body_hash") as body_hash,
-                req_h.value as dest,
-                request_headers,
-                response_headers
-            FROM
-                `httparchive.crawl.requests`,
-                UNNEST (request_headers) as req_h,
-                UNNEST (response_headers) as resp_h
-            WHERE
-                date = "{}-01" AND
-                JSON_VALUE(payload, "$._body_hash") IS NOT NULL AND
-                lower(resp_h.name) = "cache-control" AND
-                lower(resp_h.value) LIKE "%public%" AND
-                lower(req_h.name) = "sec-fetch-dest" AND
-                (lower(req_h.value) = "script" OR
-                 lower(req_h.value) = "style" OR
-                 lower(req_h.value) = "empty") AND
-                PARSE_NUMERIC(JSON_VALUE(payload, "$._responseCode")) = 200 AND
-                PARSE_NUMERIC(JSON_VALUE(payload, "$._objectSize")) > 1000
-        ) Hashes
+        FROM base
+        WHERE
+            body_hash IS NOT NULL AND
+            code = 200 AND
+            size > 1000 AND
+            lower(dest) IN ("script", "style", "empty")
         GROUP BY url, body_hash
         HAVING COUNT(*) > 20000
         ORDER BY num DESC
     """
     self.data_dir = os.path.join(os.path.dirname(__file__), 'data')
-    if not os.path.exists(self.data_dir):
-      os.makedirs(self.data_dir)
-    self.dates = []
-    today = date.today()
-    year = today.year
-    month = today.month
-    # Start with the current month after the 20th of the month
+    os.makedirs(self.data_dir, exist_ok=True)
+    # Start with the current month once its crawl is done
+    month = date.today().replace(day=1)
     if not self.is_current_crawl_done():
-      month -= 1
-    for _ in range(MONTHS):
-      if month == 0:
-        month = 12
-        year -= 1
-      self.dates.append('{}-{:02d}'.format(year, month))
-      month -= 1
+      month -= relativedelta(months=1)
+    self.dates = [
+        f'{month - relativedelta(months=offset):%Y-%m}'
+        for offset in range(MONTHS)
+    ]
     self.current_date = self.dates[0]
     self.bq_client = None
+    self.bqstorage_client = None
+    self.query_retry = bigquery.DEFAULT_RETRY.with_delay(
+        initial=1.0, maximum=60.0,
+        multiplier=2.0).with_timeout(QUERY_RETRY_TIMEOUT)
+    # Jobs that are still running are tracked on disk so an interrupted run
+    # can pick them back up instead of starting another full crawl scan
+    self.jobs_file = os.path.join(self.data_dir, 'jobs.json')
+    self.jobs_lock = threading.Lock()
     self.origins = {}
     self.patterns = []
+    self.pattern_set = set()
+    self.pattern_regexes = {}
+    self.filename_ignore_re = re.compile("|".join(
+        re.escape(ignore) for ignore in FILENAME_IGNORE))
+    self.blocklist_re = re.compile("|".join(
+        re.escape(block) for block in BLOCKLIST)) if BLOCKLIST else None
     self.destinations = {}
 
   def url_matches_pattern(self, url, pattern):
     """ See if the given URL matches the provided wildcard pattern. """
     if "*" not in pattern:
       return url == pattern
-    pat = re.escape(pattern)
-    pat = pat.replace("\\*", ".*")
-    match = re.fullmatch(pat, url)
-    return match is not None
+    regex = self.pattern_regexes.get(pattern)
+    if regex is None:
+      regex = re.compile(re.escape(pattern).replace("\\*", ".*"))
+      self.pattern_regexes[pattern] = regex
+    return regex.fullmatch(url) is not None
+
+  def clean_filename(self, filename):
+    """ Strip the FILENAME_IGNORE strings before comparing file names """
+    return self.filename_ignore_re.sub("", filename)
 
   def is_current_crawl_done(self):
     """
@@ -152,156 +189,263 @@ class Collect(object):
     for header in headers:
       name = header['name'].lower()
       value = header['value']
-      val = '{}, {}'.format(result[name], value) if name in result else value
-      result[name] = val
+      previous = result.get(name)
+      result[name] = value if previous is None else f'{previous}, {value}'
     return result
 
+  def is_public(self, cache_control):
+    """ Check for a "public" directive in the cache-control header value """
+    # Some servers (incorrectly) separate directives with a semicolon
+    for directive in re.split(r'[,;]', cache_control):
+      if directive.strip().lower() == 'public':
+        return True
+    return False
+
+  def get_results_file(self, date):
+    """ Path to the locally-cached query results for the given month """
+    return os.path.join(self.data_dir, '{}.json'.format(date))
+
+  def load_jobs(self):
+    """
+    Load the in-flight query jobs recorded by an earlier run.
+    Callers must hold jobs_lock.
+    """
+    try:
+      with open(self.jobs_file, 'rb') as f:
+        return orjson.loads(f.read())
+    except FileNotFoundError:
+      return {}
+    except orjson.JSONDecodeError:
+      # A damaged jobs file only loses the ability to resume, so start over
+      logging.info("Ignoring unreadable %s", self.jobs_file)
+      return {}
+
+  def save_job(self, date, job):
+    """ Record the query job for a month (or clear it when job is None) """
+    with self.jobs_lock:
+      jobs = self.load_jobs()
+      if job is None:
+        jobs.pop(date, None)
+      else:
+        jobs[date] = {'job_id': job.job_id, 'location': job.location}
+      if jobs:
+        # Replace the file atomically so an interrupted write never leaves a
+        # truncated jobs file behind
+        tmp_file = self.jobs_file + '.tmp'
+        with open(tmp_file, 'wb') as f:
+          f.write(orjson.dumps(jobs))
+        os.replace(tmp_file, self.jobs_file)
+      else:
+        try:
+          os.remove(self.jobs_file)
+        except FileNotFoundError:
+          pass
+
+  def resume_job(self, date):
+    """
+    Re-attach to a query job for the month that was still running when an
+    earlier run was interrupted. Finished jobs are not resumed because
+    re-running the query is answered from the query cache.
+    """
+    with self.jobs_lock:
+      info = self.load_jobs().get(date)
+    if info is None:
+      return None
+    try:
+      job = self.bq_client.get_job(info['job_id'],
+                                   location=info['location'],
+                                   retry=self.query_retry)
+    except exceptions.NotFound:
+      return None
+    if job.state == 'DONE':
+      return None
+    logging.info("Resuming query job %s for %s...", job.job_id, date)
+    return job
+
   def query_date(self, date):
-    results_file = os.path.join(self.data_dir, '{}.json'.format(date))
-    if not os.path.exists(results_file):
-      logging.info("Collecting results for %s...", date)
-      query = self.query.format(date)
-      if self.bq_client is None:
-        self.bq_client = bigquery.Client()
-      job = self.bq_client.query(query)
-      # Convert query results to a Pandas DataFrame
-      df = job.to_dataframe()
-      results = json.loads(df.to_json(orient="records", date_format='iso'))
-      with open(results_file, 'w', encoding='utf-8') as f:
-        f.write('[')
-        is_first = True
-        for result in results:
-          out = dict(result)
-          out['request_headers'] = self.process_headers(
-              result['request_headers'])
+    """ Run the query for a single month and cache the filtered results """
+    results_file = self.get_results_file(date)
+    logging.info("Collecting results for %s...", date)
+    job = self.resume_job(date)
+    if job is None:
+      # Bind the crawl date as a parameter so the query text stays constant
+      # and repeat runs can be served from the BigQuery query cache
+      job_config = bigquery.QueryJobConfig(
+          query_parameters=[
+              bigquery.ScalarQueryParameter('date', 'DATE',
+                                            '{}-01'.format(date))
+          ],
+          use_query_cache=True,
+          job_timeout_ms=QUERY_JOB_TIMEOUT_MS)
+      job = self.bq_client.query(self.query,
+                                 job_config=job_config,
+                                 retry=self.query_retry)
+      self.save_job(date, job)
+    # Download the results as Arrow record batches over the Storage Read API
+    # and stream them straight to disk, one record per line, rather than
+    # materializing the whole result set in memory
+    batches = job.result(
+        page_size=RESULTS_PAGE_SIZE,
+        retry=self.query_retry).to_arrow_iterable(
+            bqstorage_client=self.bqstorage_client)
+    # Write to a temporary file and move it into place once complete so an
+    # interrupted download is never mistaken for a cached month
+    tmp_file = results_file + '.tmp'
+    with open(tmp_file, 'wb', buffering=RESULTS_WRITE_BUFFER) as f:
+      f.write(b'[')
+      separator = b'\n'
+      for batch in batches:
+        records = []
+        for out in batch.to_pylist():
           out['response_headers'] = self.process_headers(
-              result['response_headers'])
+              out['response_headers'])
           # only allow "empty" dest if it is a compression dictionary
           if out['dest'] == 'empty' and 'use-as-dictionary' not in out[
               'response_headers']:
             continue
-          # Exclude requests with query parameters
-          if '?' in out['url']:
-            continue
           # Exclude any responses with a set-cookie response header
           if 'set-cookie' in out['response_headers']:
             continue
           # Exclude any responses that are not "cache-control: public"
           if 'cache-control' not in out[
-              'response_headers'] or 'public' not in out['response_headers'][
-                  'cache-control']:
+              'response_headers'] or not self.is_public(
+                  out['response_headers']['cache-control']):
             continue
-          # write the candidate
-          if is_first:
-            is_first = False
-            f.write('\n')
-          else:
-            f.write(',\n')
-          json.dump(out, f)
-        f.write('\n]\n')
+          records.append(orjson.dumps(out))
+        # write the batch's candidates with a single call
+        if records:
+          f.write(separator)
+          f.write(b',\n'.join(records))
+          separator = b',\n'
+      f.write(b'\n]\n')
+    os.replace(tmp_file, results_file)
+    self.save_job(date, None)
 
   def collect_raw_data(self):
     """ Run the raw bigquery queries and store the results locally """
-    for date in self.dates:
-      self.query_date(date)
+    dates = [
+        date for date in self.dates
+        if not os.path.exists(self.get_results_file(date))
+    ]
+    if not dates:
+      return
+    # Create the clients once and share them (and their connection pools and
+    # credentials) across all of the queries
+    self.bq_client = bigquery.Client()
+    if bigquery_storage is not None:
+      self.bqstorage_client = bigquery_storage.BigQueryReadClient()
+    else:
+      logging.info("google-cloud-bigquery-storage is not installed, "
+                   "downloading results over the REST API")
+    # The queries run server-side so the months can be collected in parallel
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=min(MAX_QUERY_THREADS, len(dates))) as executor:
+      list(executor.map(self.query_date, dates))
+
+  def read_results(self, date):
+    """
+    Iterate over the cached results for a month one record at a time.
+    query_date writes each record of the JSON array on its own line so the
+    file can be parsed line by line instead of all at once.
+    """
+    with open(self.get_results_file(date), 'rb') as f:
+      for line in f:
+        line = line.strip().rstrip(b',')
+        if line and line != b'[' and line != b']':
+          yield orjson.loads(line)
 
   def load_date(self, date):
-    results_file = os.path.join(self.data_dir, '{}.json'.format(date))
-    raw = []
-    with open(results_file, 'r', encoding='utf-8') as f:
-      raw = json.load(f)
-    for entry in raw:
+    for entry in self.read_results(date):
       url = entry['url']
       hash = entry['body_hash']
       num = entry['num']
-      parsed_uri = urlparse(url)
-      origin_str = '{uri.scheme}://{uri.netloc}'.format(uri=parsed_uri)
-      path = parsed_uri.path
-      # Only consider new origins if they are from the latest crawl
-      if origin_str not in self.origins and date == self.current_date:
-        self.origins[origin_str] = {}
-      if origin_str not in self.origins:
-        continue
-      origin = self.origins[origin_str]
-      if path not in origin:
-        origin[path] = {}
+      # Split on the first slash after the scheme rather than running the
+      # full urlparse() for every row (the query already excludes URLs with
+      # query strings)
+      path_start = url.find('/', url.find('://') + 3)
+      if path_start < 0:
+        path_start = len(url)
+      origin_str = url[:path_start]
+      path = url[path_start:]
+      origin = self.origins.get(origin_str)
+      if origin is None:
+        # Only consider new origins if they are from the latest crawl
+        if date != self.current_date:
+          continue
+        origin = self.origins[origin_str] = {}
+      dates = origin.get(path)
+      if dates is None:
+        dates = origin[path] = {}
         self.destinations[url] = entry['dest']
-      if date not in origin[path]:
-        origin[path][date] = {}
-      if hash not in origin[path][date]:
-        origin[path][date][hash] = {'count': 0, 'size': entry['size']}
-      origin[path][date][hash]['count'] += num
+      hashes = dates.setdefault(date, {})
+      result = hashes.setdefault(hash, {'count': 0, 'size': entry['size']})
+      result['count'] += num
+
+  def get_monthly_counts(self, dates):
+    """ Total request count for a path in each of the crawl months """
+    counts = []
+    for date in self.dates:
+      total_count = 0
+      for entry in dates.get(date, {}).values():
+        total_count += entry['count']
+      counts.append(total_count)
+    return counts
+
+  def has_multiple_hashes(self, dates):
+    """
+    Check if a path had more than one response body hash across all months,
+    stopping at the first hash that differs.
+    """
+    first = None
+    for hashes in dates.values():
+      for hash in hashes:
+        if first is None:
+          first = hash
+        elif hash != first:
+          return True
+    return False
 
   def find_pervasive_urls(self):
     """ Find URLs that were the same and pervasive for all months """
-    for origin in self.origins:
-      for path in list(self.origins[origin].keys()):
-        if len(self.origins[origin][path]) == len(self.dates):
-          is_pervasive = True
-          counts = []
-          for date in self.dates:
-            total_count = 0
-            if date in self.origins[origin][path]:
-              for hash in self.origins[origin][path][date]:
-                total_count += self.origins[origin][path][date][hash]['count']
-            counts.append(total_count)
-            if total_count < PERVASIVE_COUNT:
-              is_pervasive = False
-              break
-          if is_pervasive:
+    for origin, paths in self.origins.items():
+      for path, dates in list(paths.items()):
+        if len(dates) == len(self.dates):
+          counts = self.get_monthly_counts(dates)
+          if min(counts) >= PERVASIVE_COUNT:
             logging.info(f"Pervasive static URL {counts}: {origin}{path}")
             url = f"{origin}{path}"
-            if url not in self.patterns:
+            if url not in self.pattern_set:
               self.patterns.append(url)
-            del self.origins[origin][path]
+              self.pattern_set.add(url)
+            del paths[path]
 
-  def remove_static_urls(self):
+  def cleanup_origins(self):
     """
-    Find URLs that were present in all months and did not change.
-    We do this after extracting the pervasive ones to make sure we don't
-    use these URLs when generating patterns for the remaining resources.
+    Remove the URLs that can't be used for generating patterns, checking
+    each path once:
+    - URLs longer than 200 characters.
+    - URLs that were present in all months and did not change. We do this
+      after extracting the pervasive ones to make sure we don't use these
+      URLs when generating patterns for the remaining resources.
+    - URLs that have multiple hashes since they are updated in-place.
+    - URLs that have a blocked string in their file name.
     """
-    for origin in self.origins:
-      for path in list(self.origins[origin].keys()):
-        if len(self.origins[origin][path]) == len(self.dates):
-          hashes = []
-          for date in self.origins[origin][path]:
-            for hash in self.origins[origin][path][date]:
-              if hash not in hashes:
-                hashes.append(hash)
-          if len(hashes) == 1:
-            logging.debug(f"Removed non-pervasive static URL: {origin}{path}")
-            del self.origins[origin][path]
-
-  def remove_unversioned_urls(self):
-    """ Find URLs that have multiple hashes since they are updated in-place """
-    for origin in self.origins:
-      for path in list(self.origins[origin].keys()):
-        hashes = []
-        for date in self.origins[origin][path]:
-          for hash in self.origins[origin][path][date]:
-            if hash not in hashes:
-              hashes.append(hash)
-        if len(hashes) > 1:
-          logging.debug(f"Removed unversioned URL: {origin}{path}")
-          del self.origins[origin][path]
-
-  def remove_blocked_urls(self):
-    """ Remove any URLs that have a blocked string in their file name """
-    for origin in self.origins:
-      for path in list(self.origins[origin].keys()):
-        filepart = path.split("/")[-1]
-        if self.is_blocked(filepart):
-          logging.debug(f"Removed blocked URL: {origin}{path}")
-          del self.origins[origin][path]
-
-  def remove_long_urls(self):
-    """ Remove any URLs longer than 200 characters """
-    for origin in self.origins:
-      for path in list(self.origins[origin].keys()):
-        if len(f"{origin}{path}") > MAX_URL_LENGTH:
+    for origin, paths in self.origins.items():
+      max_path_length = MAX_URL_LENGTH - len(origin)
+      for path, dates in list(paths.items()):
+        if len(path) > max_path_length:
           logging.debug(f"Removed long URL: {origin}{path}")
-          del self.origins[origin][path]
+        else:
+          multiple_hashes = self.has_multiple_hashes(dates)
+          if len(dates) == len(self.dates) and not multiple_hashes:
+            logging.debug(f"Removed non-pervasive static URL: {origin}{path}")
+          elif multiple_hashes:
+            logging.debug(f"Removed unversioned URL: {origin}{path}")
+          elif self.is_blocked(path):
+            logging.debug(f"Removed blocked URL: {origin}{path}")
+          else:
+            continue
+        del paths[path]
 
   def find_first_difference(self, str1, str2):
     for index, (char1, char2) in enumerate(zip(str1, str2)):
@@ -309,14 +453,14 @@ class Collect(object):
         return index
     return None
 
-  def create_filename_pattern(self, path, candidates):
+  def create_filename_pattern(self, path, candidates, segments):
     """ Create a wildcard that will match only the provided filenames """
     common = None
     last = None
     first = None
-    file = path.split('/')[-1]
+    file = segments[path][-1]
     for p in candidates:
-      f = p.split('/')[-1]
+      f = segments[p][-1]
       if f != file:
         s = difflib.SequenceMatcher(None, file, f)
         matches = s.get_matching_blocks()
@@ -332,25 +476,26 @@ class Collect(object):
                 last = end
               common.append((start, end))
         else:
-          # Only include the intersection of both match sets
+          # Only include the intersection of both match sets. Both are sorted,
+          # non-overlapping ranges so they can be walked together in one pass.
+          blocks = [(start, start + size) for start, _, size in matches if size]
           intersect = []
-          last = None
-          first = None
-          for match in matches:
-            start, _, size = match
-            if size > 0:
-              end = start + size
-              for cmatch in common:
-                cstart, cend = cmatch
-                s = max(start, cstart)
-                e = min(end, cend)
-                if s < e:
-                  if first == None or s < first:
-                    first = s
-                  if last == None or e > last:
-                    last = e
-                  intersect.append((s, e))
+          index = 0
+          cindex = 0
+          while index < len(blocks) and cindex < len(common):
+            start, end = blocks[index]
+            cstart, cend = common[cindex]
+            s = max(start, cstart)
+            e = min(end, cend)
+            if s < e:
+              intersect.append((s, e))
+            if end < cend:
+              index += 1
+            else:
+              cindex += 1
           common = intersect
+          first = common[0][0] if common else None
+          last = common[-1][1] if common else None
     if common is None:
       return None
     if not common:
@@ -372,22 +517,22 @@ class Collect(object):
       pattern += "*"
     return pattern
 
-  def find_path_pattern(self, origin, path, candidates):
+  def find_path_pattern(self, origin, path, candidates, segments):
     """
     Find the cases where one path segment has the version or hash
     i.e. /maps/1.2.3/common.js
+    `segments` maps each path to its already-split path segments.
     """
-    differences = []
-    path_parts = path.split('/')
+    differences = set()
+    path_parts = segments[path]
     for candidate in candidates:
-      candidate_parts = candidate.split('/')
+      candidate_parts = segments[candidate]
       if len(candidate_parts) != len(path_parts):
         return None
       for index in range(len(path_parts)):
-        if path_parts[index] != candidate_parts[
-            index] and index not in differences:
-          differences.append(index)
-    differences.sort()
+        if path_parts[index] != candidate_parts[index]:
+          differences.add(index)
+    differences = sorted(differences)
 
     if not differences:
       return None
@@ -410,7 +555,8 @@ class Collect(object):
     if differences[-1] == len(path_parts) - 1 and (
         len(differences) == 2
         or len(path_parts) - len(differences) > MIN_STABLE_PATH):
-      filename_pattern = self.create_filename_pattern(path, candidates)
+      filename_pattern = self.create_filename_pattern(path, candidates,
+                                                      segments)
       if filename_pattern is not None:
         pattern = path
         for diff in differences[:-1]:
@@ -422,7 +568,7 @@ class Collect(object):
 
   def matches_existing_pattern(self, url):
     """ See if the given URL matches a pattern we already have """
-    if url in self.patterns:
+    if url in self.pattern_set:
       return True
     for pattern in self.patterns:
       if self.url_matches_pattern(url, pattern):
@@ -434,11 +580,34 @@ class Collect(object):
     Check to see if the file component of the path has any of the
     blocked strings in it.
     """
-    file = path.split('/')[-1]
-    for block in BLOCKLIST:
-      if block in file:
-        return True
-    return False
+    if self.blocklist_re is None:
+      return False
+    file = path.rpartition('/')[2]
+    return self.blocklist_re.search(file) is not None
+
+  def is_similar_filename(self, filepart, cfilepart, matchers):
+    """
+    Check that two (cleaned) file names are similar enough to be versions of
+    the same file: a high enough difflib ratio with few matching blocks.
+    """
+    # Identical names always match (a ratio of 1.0 with a single block)
+    if filepart == cfilepart:
+      return True
+    # difflib indexes the second sequence, so keep a matcher per candidate
+    # file name and only swap in the target name for each comparison
+    s = matchers.get(cfilepart)
+    if s is None:
+      s = difflib.SequenceMatcher(None)
+      s.set_seq2(cfilepart)
+      matchers[cfilepart] = s
+    s.set_seq1(filepart)
+    # real_quick_ratio() and quick_ratio() are cheap upper bounds on ratio()
+    # so most dissimilar names are rejected before the full match
+    if s.real_quick_ratio() < MIN_FILENAME_RATIO or \
+        s.quick_ratio() < MIN_FILENAME_RATIO or \
+        s.ratio() < MIN_FILENAME_RATIO:
+      return False
+    return len(s.get_matching_blocks()) <= MAX_FILENAME_MATCHING_BLOCKS
 
   def find_patterns(self):
     """
@@ -447,55 +616,68 @@ class Collect(object):
     """
     for origin in self.origins:
       o = self.origins[origin]
-      for path in list(o.keys()):
-        url = f"{origin}{path}"
-        filepart = path.split('/')[-1]
-        for ignore in FILENAME_IGNORE:
-          filepart = filepart.replace(ignore, "")
-        if url in self.destinations and path in o and self.current_date in o[
+      matchers = {}
+      # Snapshot the paths once along with their segments and cleaned file
+      # names. Paths that get folded into a pattern are tracked in `deleted`
+      # and removed from the origin in a single sweep at the end.
+      paths = list(o.keys())
+      segments = {p: p.split('/') for p in paths}
+      fileparts = {p: self.clean_filename(segments[p][-1]) for p in paths}
+      urls = {p: f"{origin}{p}" for p in paths}
+      dests = {p: self.destinations.get(urls[p]) for p in paths}
+      deleted = set()
+      # Bucket the paths by segment count, destination and file name length
+      # so each target only scans the compatible ones. Buckets hold indexes
+      # into `paths` so the original order (which the size window depends on)
+      # can be restored.
+      buckets = {}
+      for index, p in enumerate(paths):
+        key = (len(segments[p]), dests[p], len(fileparts[p]))
+        buckets.setdefault(key, []).append(index)
+      for path in paths:
+        if path in deleted:
+          continue
+        url = urls[path]
+        dest = dests[path]
+        filepart = fileparts[path]
+        if dest is not None and self.current_date in o[
             path] and not self.matches_existing_pattern(url):
-          dest = self.destinations[url]
           hash = list(o[path][self.current_date].keys())[0]
           target_size = o[path][self.current_date][hash]['size']
-          path_segments = len(path.split('/'))
+          path_segments = len(segments[path])
           # Find candidate paths that are within 5% of the target size
           # (assume minor changes from version to version)
           # with "similar" urls
           candidates = []
           target_size_min = target_size
           target_size_max = target_size
-          for p in list(o.keys()):
-            curl = f"{origin}{p}"
-            cdest = self.destinations[
-                curl] if curl in self.destinations else None
-            cfilepart = p.split('/')[-1]
-            for ignore in FILENAME_IGNORE:
-              cfilepart = cfilepart.replace(ignore, "")
-            s = difflib.SequenceMatcher(None, filepart, cfilepart)
-            similarity = s.ratio()
-            block_count = len(s.get_matching_blocks())
-            if p != path and \
-                    p not in candidates and \
-                    cdest == dest and \
-                    len(p.split('/')) == path_segments and \
-                    similarity >= MIN_FILENAME_RATIO and \
-                    block_count <= MAX_FILENAME_MATCHING_BLOCKS and \
-                    abs(len(filepart) - len(cfilepart)) <= \
-                        MAX_FILENAME_LENGTH_DIFFERENCE:
-              date = list(o[p].keys())[0]
-              hash = list(o[p][date].keys())[0]
-              size = o[p][date][hash]['size']
-              size_delta = 0
-              if size < target_size_min:
-                size_delta = (target_size_min - size) * 100
-              elif size > target_size_max:
-                size_delta = (size - target_size_max) * 100
-              if size_delta / target_size <= SIZE_MATCH_PERCENT:
-                target_size_min = min(target_size_min, size)
-                target_size_max = max(target_size_max, size)
-                candidates.append(p)
+          nearby = []
+          for length in range(
+              len(filepart) - MAX_FILENAME_LENGTH_DIFFERENCE,
+              len(filepart) + MAX_FILENAME_LENGTH_DIFFERENCE + 1):
+            nearby.extend(buckets.get((path_segments, dest, length), []))
+          for index in sorted(nearby):
+            p = paths[index]
+            if p == path or p in deleted:
+              continue
+            cfilepart = fileparts[p]
+            if not self.is_similar_filename(filepart, cfilepart, matchers):
+              continue
+            date = list(o[p].keys())[0]
+            hash = list(o[p][date].keys())[0]
+            size = o[p][date][hash]['size']
+            size_delta = 0
+            if size < target_size_min:
+              size_delta = (target_size_min - size) * 100
+            elif size > target_size_max:
+              size_delta = (size - target_size_max) * 100
+            if size_delta / target_size <= SIZE_MATCH_PERCENT:
+              target_size_min = min(target_size_min, size)
+              target_size_max = max(target_size_max, size)
+              candidates.append(p)
           if candidates:
-            pattern = self.find_path_pattern(origin, path, candidates)
+            pattern = self.find_path_pattern(origin, path, candidates,
+                                             segments)
             if pattern:
               for sub in WILDCARD_REPLACE:
                 pattern = pattern.replace(sub, "*")
@@ -503,21 +685,19 @@ class Collect(object):
                 pattern = pattern.replace("/*/*/", "/*/")
               # Make sure the aggregate of all of the candidates meet the
               # pervasive threshold
-              matched_urls = []
+              matched_urls = [
+                  p for p in paths
+                  if p not in deleted and self.url_matches_pattern(p, pattern)
+              ]
               counts = []
-              is_pervasive = True
               for date in self.dates:
                 total_count = 0
-                for p in o:
-                  if self.url_matches_pattern(p, pattern):
-                    matched_urls.append(p)
-                    if date in o[p]:
-                      hash = list(o[p][date].keys())[0]
-                      total_count += o[p][date][hash]['count']
+                for p in matched_urls:
+                  if date in o[p]:
+                    hash = list(o[p][date].keys())[0]
+                    total_count += o[p][date][hash]['count']
                 counts.append(total_count)
-                if total_count < PERVASIVE_COUNT:
-                  is_pervasive = False
-              if is_pervasive:
+              if min(counts) >= PERVASIVE_COUNT:
                 logging.info(f"Pattern {counts}: {origin}{pattern}")
                 logging.info(f"             URL: {origin}{path}")
                 for path2 in sorted(candidates):
@@ -525,24 +705,19 @@ class Collect(object):
                 for path2 in sorted(matched_urls):
                   logging.info(f"         Matched: {origin}{path2}")
                 self.patterns.append(f"{origin}{pattern}")
+                self.pattern_set.add(f"{origin}{pattern}")
               # clean up all of the paths that were used with the pattern
-              for path2 in matched_urls:
-                if path2 in o:
-                  del o[path2]
+              deleted.update(matched_urls)
               continue
+      for path in deleted:
+        del o[path]
 
   def show_unmatched(self):
     """ Display the remaining unmatched URLs """
-    for origin in self.origins:
-      for path in sorted(list(self.origins[origin].keys())):
-        if self.current_date in self.origins[origin][path]:
-          counts = []
-          for date in self.dates:
-            total_count = 0
-            if date in self.origins[origin][path]:
-              for hash in self.origins[origin][path][date]:
-                total_count += self.origins[origin][path][date][hash]['count']
-            counts.append(total_count)
+    for origin, paths in self.origins.items():
+      for path, dates in sorted(paths.items()):
+        if self.current_date in dates:
+          counts = self.get_monthly_counts(dates)
           logging.info(f"Unmatched URL {counts}: {origin}{path}")
 
   def write_patterns(self):
@@ -596,24 +771,32 @@ class Collect(object):
 
   def remove_duplicate_patterns(self):
     """ Remove patterns that are already covered by a more general pattern """
-    for pattern1 in list(self.patterns):
-      for pattern2 in list(self.patterns):
-        if pattern1 != pattern2 and len(pattern1) != len(pattern2):
-          shorter = pattern1 if len(pattern1) < len(pattern2) else pattern2
-          longer = pattern1 if len(pattern1) > len(pattern2) else pattern2
-          if self.url_matches_pattern(longer, shorter):
-            logging.info(f"Removed pattern {longer} as duplicate of {shorter}")
-            self.patterns.remove(longer)
+    # A pattern can only cover patterns that start with its literal prefix
+    # (everything before the first wildcard) so only that sorted range needs
+    # to be checked instead of every pair.
+    sorted_patterns = sorted(self.patterns)
+    removed = set()
+    for shorter in sorted(self.patterns, key=len):
+      prefix = shorter.split('*', 1)[0]
+      index = bisect.bisect_left(sorted_patterns, prefix)
+      while index < len(sorted_patterns) and sorted_patterns[index].startswith(
+          prefix):
+        longer = sorted_patterns[index]
+        index += 1
+        if len(longer) > len(shorter) and longer not in removed and \
+            self.url_matches_pattern(longer, shorter):
+          logging.info(f"Removed pattern {longer} as duplicate of {shorter}")
+          removed.add(longer)
+    if removed:
+      self.patterns = [p for p in self.patterns if p not in removed]
+      self.pattern_set -= removed
 
   def aggregate_urls(self):
     """ Load the raw results and group them by origin """
     for date in self.dates:
       self.load_date(date)
     self.find_pervasive_urls()
-    self.remove_long_urls()
-    self.remove_static_urls()
-    self.remove_unversioned_urls()
-    self.remove_blocked_urls()
+    self.cleanup_origins()
     self.find_patterns()
     self.remove_duplicate_patterns()
     self.show_unmatched()